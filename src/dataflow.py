@@ -1,26 +1,28 @@
+import heapq
 from abc import ABC, abstractmethod
-from collections import defaultdict
 from collections.abc import Iterable
+from weakref import WeakKeyDictionary, ref
 
 from code_analysis import CFG
 
 
 def is_definition(cfg: CFG, nid: int) -> bool:
-    return any(
-        [
-            cfg.get_type(cfg.get_children(nid)[0]) == "ValueParameter",
-            (
-                cfg.get_type(cfg.get_children(cfg.get_children(nid)[0])[0])
-                == "OptValueParameter"
-            ),
-            (
-                cfg.get_type(cfg.get_children(nid)[0]) == "BinOP"
-                and cfg.get_image(cfg.get_children(nid)[0]) == "="
-            ),
-            "MemberDeclaration" in cfg.get_type(cfg.get_parents(nid)[0]),
-            cfg.get_type(cfg.get_parents(nid)[0]) == "Global",
-        ]
-    )
+    children = cfg.get_children(nid)
+    if children:
+        child = children[0]
+        child_type = cfg.get_type(child)
+        if child_type == "ValueParameter":
+            return True
+        if child_type == "BinOP" and cfg.get_image(child) == "=":
+            return True
+        grandchildren = cfg.get_children(child)
+        if grandchildren and cfg.get_type(grandchildren[0]) == "OptValueParameter":
+            return True
+    parents = cfg.get_parents(nid)
+    if not parents:
+        return False
+    parent_type = cfg.get_type(parents[0])
+    return parent_type == "Global" or "MemberDeclaration" in parent_type
 
 
 def yield_all_vars(cfg: CFG) -> Iterable[int]:
@@ -45,151 +47,288 @@ def get_key(cfg: CFG, nid: int) -> tuple[str, str]:
     return (cfg.get_var_scope(nid), cfg.get_var_id(nid))
 
 
-class DataFlowAlgorithm(ABC):
-    def __init__(self):
-        self.cfg: CFG
-
-        self.in_dict: dict[int, set[int]]
-        self.out_dict: dict[int, set[int]]
+def join(sets: list[int], nids: tuple[int, ...]) -> int:
+    # A lone operand is returned as is rather than rebuilt, so straight-line
+    # code passes the same mask along; callers still get their own sets
+    if len(nids) == 1:
+        return sets[nids[0]]
+    bits = 0
+    for nid in nids:
+        bits |= sets[nid]
+    return bits
+
+
+def solve(
+    next_nodes: list[tuple[int, ...]],
+    prev_nodes: list[tuple[int, ...]],
+    gen: list[int],
+    kill: list[int],
+) -> tuple[list[int], list[int]]:
+    # Nodes are dense indices numbered in reverse post-order, so popping the
+    # smallest index from the heap processes the worklist in that order
+    n = len(next_nodes)
+    after = [0] * n
+    # Every node is evaluated once, then again only when an input changed
+    worklist = list(range(n))
+    queued = bytearray(b"\x01") * n
+    while worklist:
+        nid = heapq.heappop(worklist)
+        queued[nid] = 0
+        # Only the "after" sets are stored, "before" is the join of them
+        before = join(after, prev_nodes[nid])
+        if gen[nid] or kill[nid]:
+            flow = gen[nid] | (before & ~kill[nid])
+        else:
+            flow = before
+        if flow != after[nid]:
+            after[nid] = flow
+            for next_nid in next_nodes[nid]:
+                if not queued[next_nid]:
+                    heapq.heappush(worklist, next_nid)
+                    queued[next_nid] = 1
+
+    before = [join(after, prev_nids) for prev_nids in prev_nodes]
+    return before, after
+
+
+class AnalysisContext:
+    # Snapshot of everything an analysis needs from a CFG that does not depend
+    # on the analysis itself. Pass the same context to several analyses to
+    # share it; it has to be rebuilt if the CFG is modified afterwards
+    def __init__(self, cfg: CFG):
+        # Weak, so that a cached context does not keep its CFG alive
+        self.cfg = ref(cfg)
+        node_ids = cfg.get_node_ids()
+        self.types = {nid: cfg.get_type(nid) for nid in node_ids}
+        self.succ = {nid: tuple(cfg.get_any_children(nid)) for nid in node_ids}
+        # Same edges as get_any_parents, without a second CFG lookup per node
+        preds: dict[int, list[int]] = {nid: [] for nid in node_ids}
+        for nid, next_nids in self.succ.items():
+            for next_nid in next_nids:
+                preds[next_nid].append(nid)
+        self.pred = {nid: tuple(prev_nids) for nid, prev_nids in preds.items()}
+
+        self.entries: list[int] = []
+        self.exits: list[int] = []
+        self.var_key_idx: dict[int, int] = {}
+        key_id: dict[tuple[str, str], int] = {}
+        for nid, node_type in self.types.items():
+            if node_type == "Variable":
+                key = get_key(cfg, nid)
+                self.var_key_idx[nid] = key_id.setdefault(key, len(key_id))
+            elif node_type == "Entry":
+                self.entries.append(nid)
+            elif node_type == "Exit":
+                self.exits.append(nid)
+        self.var_keys: list[tuple[str, str]] = list(key_id)
+
+        # Only variables need classifying, straight from the CFG
+        self.is_def = {nid: is_definition(cfg, nid) for nid in self.var_key_idx}
+        self.defs = [nid for nid, is_def in self.is_def.items() if is_def]
+        self.refs = [nid for nid, is_def in self.is_def.items() if not is_def]
+
+        # Reverse post-orders, per analysis since they depend on its direction
+        self.rpo: dict[type, dict[int, int]] = {}
+
+
+# Opt-in cache for callers that know their CFGs are no longer modified
+_cfg_cache = WeakKeyDictionary[CFG, AnalysisContext]()
+
+
+def get_context(cfg: CFG) -> AnalysisContext:
+    context = _cfg_cache.get(cfg)
+    if context is None:
+        context = _cfg_cache[cfg] = AnalysisContext(cfg)
+    return context
 
-        self.all_defs: dict[tuple[str, str], set[int]]
-        self.gen_dict: dict[int, set[int]]
-        self.kill_dict: dict[int, set[int]]
 
-        self.visited: set[int]
-        self.worklist: list[int]
-
-    def build_defs(self) -> dict[tuple[str, str], set[int]]:
-        all_defs = defaultdict[tuple[str, str], set[int]](set)
-        for nid in yield_all_defs(self.cfg):
-            key = get_key(self.cfg, nid)
-            all_defs[key].add(nid)
+class DataFlowAlgorithm(ABC):
+    def __init__(self):
+        self.context: AnalysisContext
+
+        self.in_dict: dict[int, int]
+        self.out_dict: dict[int, int]
+
+        self.var_index: dict[int, int]
+        self.var_nids: list[int]
+
+        self.all_defs: list[int]
+        self.gen_dict: dict[int, int]
+        self.kill_dict: dict[int, int]
+
+    def build_index(self) -> dict[int, int]:
+        # Only nodes the analysis can generate get a bit, keeping masks dense
+        return {nid: bit for bit, nid in enumerate(self.yield_gen_nodes())}
+
+    def to_set(self, bits: int) -> frozenset[int]:
+        # Scan the binary digits least significant first, one find per bit
+        digits = bin(bits)[:1:-1]
+        nids: list[int] = []
+        bit = digits.find("1")
+        while bit >= 0:
+            nids.append(self.var_nids[bit])
+            bit = digits.find("1", bit + 1)
+        return frozenset(nids)
+
+    def to_sets(
+        self, bits_dict: dict[int, int], decoded: dict[int, frozenset[int]]
+    ) -> dict[int, set[int]]:
+        # Few distinct masks are shared by many nodes, decode each only once
+        for bits in set(bits_dict.values()).difference(decoded):
+            decoded[bits] = self.to_set(bits)
+        return {nid: set(decoded[bits]) for nid, bits in bits_dict.items()}
+
+    def build_defs(self) -> list[int]:
+        # Definitions of each variable, indexed by interned key
+        var_key_idx = self.context.var_key_idx
+        all_defs = [0] * len(self.context.var_keys)
+        for nid in self.context.defs:
+            bit = self.var_index.get(nid)
+            if bit is not None:
+                all_defs[var_key_idx[nid]] |= 1 << bit
         return all_defs
 
     @abstractmethod
-    def build_gen(self) -> dict[int, set[int]]:
+    def yield_gen_nodes(self) -> Iterable[int]:
         ...
 
-    def build_kill(self) -> dict[int, set[int]]:
-        kill_dict = defaultdict[int, set[int]](set)
-        for nid, var_nids in self.gen_dict.items():
-            for var_nid in var_nids:
-                key = get_key(self.cfg, var_nid)
-                kill_dict[nid] |= self.all_defs[key] - var_nids
+    def build_gen(self) -> dict[int, int]:
+        gen_dict = dict.fromkeys(self.context.types, 0)
+        for nid, bit in self.var_index.items():
+            gen_dict[nid] = 1 << bit
+        return gen_dict
+
+    def build_kill(self) -> dict[int, int]:
+        var_key_idx = self.context.var_key_idx
+        kill_dict = dict.fromkeys(self.context.types, 0)
+        for nid in self.var_index:
+            defs = self.all_defs[var_key_idx[nid]]
+            kill_dict[nid] = defs & ~self.gen_dict[nid]
         return kill_dict
 
-    @abstractmethod
-    def pre_loop_init(self) -> Iterable[None]:
-        ...
+    def build_rpo(self) -> dict[int, int]:
+        # Reverse post-order in the direction of the analysis
+        next_nodes = self.next_nodes()
+        postorder = list[int]()
+        seen = set[int]()
+        for root in self.start_nodes():
+            if root in seen:
+                continue
+            seen.add(root)
+            stack = [(root, iter(next_nodes[root]))]
+            while stack:
+                nid, next_nids = stack[-1]
+                for next_nid in next_nids:
+                    if next_nid not in seen:
+                        seen.add(next_nid)
+                        stack.append((next_nid, iter(next_nodes[next_nid])))
+                        break
+                else:
+                    stack.pop()
+                    postorder.append(nid)
+        return {nid: rank for rank, nid in enumerate(reversed(postorder))}
 
     @abstractmethod
-    def apply_flow_eq(self, nid: int) -> None:
+    def start_nodes(self) -> Iterable[int]:
         ...
 
     @abstractmethod
-    def next_nodes(self, nid: int) -> Iterable[int]:
+    def flow_dicts(self) -> tuple[dict[int, int], dict[int, int]]:
+        # (before, after) dicts of the flow equation, in analysis direction
         ...
 
     @abstractmethod
-    def can_propagate(self, nid: int, next_nid: int) -> bool:
+    def next_nodes(self) -> dict[int, tuple[int, ...]]:
         ...
 
     @abstractmethod
-    def propagate(self, nid: int, next_nid: int):
+    def prev_nodes(self) -> dict[int, tuple[int, ...]]:
         ...
 
-    def __call__(self, cfg: CFG) -> tuple[dict[int, set[int]], dict[int, set[int]]]:
-        self.cfg = cfg
+    def __call__(
+        self, cfg: CFG, context: AnalysisContext | None = None
+    ) -> tuple[dict[int, set[int]], dict[int, set[int]]]:
+        if context is None:
+            context = AnalysisContext(cfg)
+        elif context.cfg() is not cfg:
+            raise ValueError("context was built from another CFG")
+        self.context = context
+
+        self.var_index = self.build_index()
+        self.var_nids = list(self.var_index)
 
         self.all_defs = self.build_defs()
         self.gen_dict = self.build_gen()
         self.kill_dict = self.build_kill()
 
-        self.in_dict = defaultdict(set)
-        self.out_dict = defaultdict(set)
-
-        self.visited = set()
-        self.worklist = []
-        for _ in self.pre_loop_init():
-            while self.worklist:
-                nid = self.worklist.pop()
-                self.apply_flow_eq(nid)
-                for next_nid in self.next_nodes(nid):
-                    if next_nid not in self.visited or self.can_propagate(
-                        nid, next_nid
-                    ):
-                        self.propagate(nid, next_nid)
-                        self.worklist.append(next_nid)
-                        self.visited.add(next_nid)
+        # Every node gets an entry up front, 0 being the empty set
+        self.in_dict = dict.fromkeys(self.context.types, 0)
+        self.out_dict = dict.fromkeys(self.context.types, 0)
+
+        rpo = self.context.rpo.get(type(self))
+        if rpo is None:
+            rpo = self.context.rpo[type(self)] = self.build_rpo()
+        nids = list(rpo)
+        next_nodes, prev_nodes = self.next_nodes(), self.prev_nodes()
+        before, after = solve(
+            [tuple([rpo[m] for m in next_nodes[nid]]) for nid in nids],
+            # Unreachable nodes never flow anything, they can be left out
+            [tuple([rpo[m] for m in prev_nodes[nid] if m in rpo]) for nid in nids],
+            [self.gen_dict[nid] for nid in nids],
+            [self.kill_dict[nid] for nid in nids],
+        )
 
-        return self.in_dict, self.out_dict
+        before_dict, after_dict = self.flow_dicts()
+        before_dict.update(zip(nids, before))
+        after_dict.update(zip(nids, after))
+
+        decoded = dict[int, frozenset[int]]()
+        return (
+            self.to_sets(self.in_dict, decoded),
+            self.to_sets(self.out_dict, decoded),
+        )
 
 
 class PossiblyReachingDefinitions(DataFlowAlgorithm):
-    def build_gen(self) -> dict[int, set[int]]:
-        gen_dict = defaultdict[int, set[int]](set)
-        for nid in yield_all_defs(self.cfg):
-            gen_dict[nid].add(nid)
-        return gen_dict
+    def yield_gen_nodes(self) -> Iterable[int]:
+        return self.context.defs
 
-    def pre_loop_init(self) -> Iterable[None]:
-        for entry_nid in self.get_entry_node():
-            self.in_dict[entry_nid] = set()
-            self.visited.add(entry_nid)
-            self.worklist.append(entry_nid)
-            yield
+    def start_nodes(self) -> Iterable[int]:
+        return self.get_entry_node()
 
     def get_entry_node(self) -> Iterable[int]:
-        node_ids = self.cfg.get_node_ids()
-        for nid in node_ids:
-            if self.cfg.get_type(nid) == "Entry":
-                yield nid
-
-    def apply_flow_eq(self, nid: int) -> None:
-        self.out_dict[nid] = self.gen_dict[nid] | (
-            self.in_dict[nid] - self.kill_dict[nid]
-        )
+        return self.context.entries
 
-    def next_nodes(self, nid: int) -> Iterable[int]:
-        return self.cfg.get_any_children(nid)
+    def flow_dicts(self) -> tuple[dict[int, int], dict[int, int]]:
+        return self.in_dict, self.out_dict
 
-    def can_propagate(self, nid: int, next_nid: int) -> bool:
-        return (self.out_dict[nid] - self.in_dict[next_nid]) != set()
+    def next_nodes(self) -> dict[int, tuple[int, ...]]:
+        return self.context.succ
 
-    def propagate(self, nid: int, next_nid: int) -> None:
-        self.in_dict[next_nid] |= self.out_dict[nid]
+    def prev_nodes(self) -> dict[int, tuple[int, ...]]:
+        return self.context.pred
 
 
 class PossibleReachableReferences(DataFlowAlgorithm):
-    def build_gen(self) -> dict[int, set[int]]:
-        gen_dict = defaultdict[int, set[int]](set)
-        for nid in yield_all_refs(self.cfg):
-            gen_dict[nid].add(nid)
-        return gen_dict
+    def yield_gen_nodes(self) -> Iterable[int]:
+        return self.context.refs
 
-    def pre_loop_init(self) -> Iterable[None]:
-        for exit_nid in self.get_exit_node():
-            self.out_dict[exit_nid] = set()
-            self.visited.add(exit_nid)
-            self.worklist.append(exit_nid)
-            yield
+    def build_defs(self) -> list[int]:
+        # Only definitions kill and none of them gets a bit in this analysis,
+        # so references are never killed
+        return [0] * len(self.context.var_keys)
+
+    def start_nodes(self) -> Iterable[int]:
+        return self.get_exit_node()
 
     def get_exit_node(self) -> Iterable[int]:
-        node_ids = self.cfg.get_node_ids()
-        for nid in node_ids:
-            if self.cfg.get_type(nid) == "Exit":
-                yield nid
-
-    def apply_flow_eq(self, nid: int) -> None:
-        self.in_dict[nid] = self.gen_dict[nid] | (
-            self.out_dict[nid] - self.kill_dict[nid]
-        )
+        return self.context.exits
 
-    def next_nodes(self, nid: int) -> Iterable[int]:
-        return self.cfg.get_any_parents(nid)
+    def flow_dicts(self) -> tuple[dict[int, int], dict[int, int]]:
+        return self.out_dict, self.in_dict
 
-    def can_propagate(self, nid: int, next_nid: int) -> bool:
-        return (self.in_dict[nid] - self.out_dict[next_nid]) != set()
+    def next_nodes(self) -> dict[int, tuple[int, ...]]:
+        return self.context.pred
 
-    def propagate(self, nid: int, next_nid: int) -> None:
-        self.out_dict[next_nid] |= self.in_dict[nid]
+    def prev_nodes(self) -> dict[int, tuple[int, ...]]:
+        return self.context.succ